@@ -1,15 +1,19 @@
 import os
+import re
 import shutil
 import zipfile
-from time import sleep
-from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import openpyxl
 import requests
-from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import ImageFile
 
 from dotenv import load_dotenv
 
+import render
+
 
 # Env variables
 load_dotenv()
@@ -18,6 +22,44 @@ IMAGES_FOLDER = os.getenv("IMAGES_FOLDER")
 EXCEL_SHEET = os.getenv("EXCEL_SHEET")
 
 
+def _get_webp_size(image_data: bytes) -> tuple[int, int]:
+    """ Read WebP width and height from its RIFF header (first 30 bytes)
+
+    Args:
+        image_data (bytes): image first bytes
+        
+    Returns:
+        tuple[int, int]: image width and height (None if is not a WebP)
+    """
+    
+    if len(image_data) < 30:
+        return None
+    if image_data[0:4] != b"RIFF" or image_data[8:12] != b"WEBP":
+        return None
+    
+    chunk = image_data[12:16]
+    if chunk == b"VP8 ":
+        # Lossy: 14 bits sizes after frame tag and start code
+        if image_data[23:26] != b"\x9d\x01\x2a":
+            return None
+        width = int.from_bytes(image_data[26:28], "little") & 0x3fff
+        height = int.from_bytes(image_data[28:30], "little") & 0x3fff
+        return width, height
+    if chunk == b"VP8L":
+        # Lossless: 14 bits sizes (minus one) after signature
+        if image_data[20] != 0x2f:
+            return None
+        bits = int.from_bytes(image_data[21:25], "little")
+        return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+    if chunk == b"VP8X":
+        # Extended: 24 bits canvas sizes (minus one) after flags
+        width = int.from_bytes(image_data[24:27], "little") + 1
+        height = int.from_bytes(image_data[27:30], "little") + 1
+        return width, height
+    
+    return None
+
+
 class PageGenerator():
     def __init__(self):
         """ Initialize PageGenerator object
@@ -31,13 +73,13 @@ class PageGenerator():
         self.template_path = os.path.join(self.current_folder, "template.html")
         self.excel_path = os.path.join(self.current_folder, "input.xlsx")
         self.htmls_folder = os.path.join(self.current_folder, "htmls")
-        
-        # Create folders if not exists
-        os.makedirs(self.htmls_folder, exist_ok=True)
+        self._htmls_prefix = self.htmls_folder + os.sep
         
         # Data variables
         self.excel_data = []
         self.excel_header = []
+        self._col_idx = {}
+        self._images_sizes_cache = {}
         
         # Validation data
         self.columns = {
@@ -54,53 +96,101 @@ class PageGenerator():
         self.columns_row = self.columns["row"]
         self.columns_names = self.columns["names"]
         
-        # Load excel data and validate columns
+        # Http session (reuse connections to download images)
+        # Throttling is done with retries and backoff when server is busy
+        self._session = requests.Session()
+        retries = Retry(
+            total=3,
+            backoff_factor=0.1,
+            status_forcelist=[429, 500, 502, 503, 504],
+        )
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=retries
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        
+        # Template placeholders like "[column name]"
+        self._placeholder_re = re.compile(r"\[([^\[\]]+)\]")
+        
+        # Load excel data (validating columns) and replace images paths
         self.__load_excel_data__()
-        self.__save_header__()
-        self.__validate_excel_columns__()
         
-        # Process data
-        self.__replace_images_paths__()
+        # Load template and resolve its placeholders
+        self.__load_template__()
         
         # Process folders
         self.__clean_htmls_folder__()
         
     def __load_excel_data__(self):
-        """ Read excel data and save in instance
+        """ Read excel data and save in instance.
+        Header, validation and images paths are processed in a single pass
         """
         
         print("Loading excel data...")
         
-        # Validate excel path
-        if not os.path.exists(self.excel_path):
-            raise FileNotFoundError(f"Excel file not found: {self.excel_path}")
-        
-        # Read excel
-        wb = openpyxl.load_workbook(self.excel_path)
-        current_sheet = wb[EXCEL_SHEET]
-        
-        rows = current_sheet.max_row
-        columns = current_sheet.max_column
+        # Read excel (read only mode, rows are read sequentially)
+        try:
+            wb = openpyxl.load_workbook(
+                self.excel_path,
+                read_only=True,
+                data_only=True
+            )
+        except FileNotFoundError:
+            raise FileNotFoundError(f"Excel file not found: {self.excel_path}") from None
 
-        data = []
-        for row in range(1, rows + 1):
+        try:
+            current_sheet = wb[EXCEL_SHEET]
 
-            row_data = []
-            for column in range(1, columns + 1):
-                cell_data = current_sheet.cell(row, column).value
-                row_data.append(cell_data)
+            # Recalculate dimensions when the file does not store them
+            # (rows are padded later, as they are read without trailing cells)
+            try:
+                dimension = current_sheet.calculate_dimension()
+            except ValueError:
+                dimension = None
+            if dimension in (None, "A1:A1"):
+                current_sheet.reset_dimensions()
 
-            data.append(row_data)
+            rows = current_sheet.iter_rows(values_only=True)
+            
+            # Save and validate header before reading data rows
+            self.__save_header__(rows)
+            self.__validate_excel_columns__()
+            
+            # Identify images columns
+            self._image_col_indexes = [
+                column_index for column_index, column_name
+                in enumerate(self.excel_header) if "image" in str(column_name)
+            ]
+            
+            # Read data rows replacing images paths
+            data = list(self.__replace_images_paths__(rows))
+        finally:
+            wb.close()
 
         self.excel_data = data
         
-    def __save_header__(self):
-        """ Save in instance the excel header """
+    def __save_header__(self, rows):
+        """ Save in instance the excel header
+        
+        Args:
+            rows (iterator): excel rows values, consumed until the header row
+        """
         
         template_row = self.columns_row
-        excel_header = self.excel_data[template_row - 1]
+        for _ in range(template_row - 1):
+            next(rows, None)
+        excel_header = list(next(rows, []))
         self.excel_header = excel_header
         
+        # Column name to column index, to avoid searching in header
+        # (first column wins when a name is repeated)
+        self._col_idx = {}
+        for column_index, column_name in enumerate(excel_header):
+            self._col_idx.setdefault(column_name, column_index)
+        
     def __validate_excel_columns__(self):
         """ Check specific columns and column's order in excel """
         
@@ -108,39 +198,73 @@ class PageGenerator():
         
         # Validete excel header
         for column_name in self.columns_names:
-            if column_name not in self.excel_header:
+            if column_name not in self._col_idx:
                 error = f"Column '{column_name}' not found in excel"
                 error += f"\nExcel columns: {self.excel_header}"
                 raise ValueError(error)
             
-    def __replace_images_paths__(self):
-        """ Replace images paths using relative paths and images folder """
+    def __load_template__(self):
+        """ Split template in literal segments and placeholders slots """
+        
+        print("Loading template...")
+        
+        with open(self.template_path, "r") as file:
+            template_content = file.read()
+        
+        # Odd parts are placeholders names, even parts are literal text
+        parts = self._placeholder_re.split(template_content)
+        
+        # Excel columns used in template, only their values are rendered
+        placeholders_names = parts[1::2]
+        used_names = list(dict.fromkeys(
+            name for name in placeholders_names if name in self._col_idx
+        ))
+        self._used_cols = [(name, self._col_idx[name]) for name in used_names]
+        
+        # Position of each placeholder in used columns values
+        # (name if is not an excel column)
+        used_positions = {name: position for position, name in enumerate(used_names)}
+        slots = []
+        for placeholder_name in placeholders_names:
+            slots.append(used_positions.get(placeholder_name, placeholder_name))
+        
+        # Literal text encoded once, pages are rendered directly as bytes
+        self._template_segments = [part.encode("utf-8") for part in parts[0::2]]
+        self._template_slots = slots
+            
+    def __replace_images_paths__(self, rows):
+        """ Replace images paths using relative paths and images folder
+        
+        Args:
+            rows (iterator): excel data rows values
+            
+        Yields:
+            list: row values with images paths replaced
+        """
         
-        # Identify images columns
-        images_columns_indexes = []
-        for column_name in self.excel_header:
-            if "image" in str(column_name):
-                column_index = self.excel_header.index(column_name)
-                images_columns_indexes.append(column_index)
+        # Local names used in the rows loop
+        images_prefix = f"{DOMAIN}/{IMAGES_FOLDER}/"
+        image_col_indexes = self._image_col_indexes
+        columns = len(self.excel_header)
         
-        # Replace images paths
-        for row in self.excel_data[self.columns_row:]:
-            for column_index in images_columns_indexes:
-                image_file = row[column_index]
-                new_image_path = f"{DOMAIN}/{IMAGES_FOLDER}/{image_file}"
-                row[column_index] = new_image_path
+        for row in rows:
+            
+            # Pad rows read without their trailing empty cells
+            row = list(row)
+            if len(row) < columns:
+                row.extend([None] * (columns - len(row)))
+            for column_index in image_col_indexes:
+                row[column_index] = f"{images_prefix}{row[column_index]}"
+            yield row
 
     def __clean_htmls_folder__(self):
         """ Clean html folder """
         
         print("Cleaning html folder...")
         
-        for file in os.listdir(self.htmls_folder):
-            file_path = os.path.join(self.htmls_folder, file)
-            if os.path.isfile(file_path):
-                os.remove(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
+        # Delete and create again the folder (also creates it if not exists)
+        shutil.rmtree(self.htmls_folder, ignore_errors=True)
+        os.makedirs(self.htmls_folder, exist_ok=True)
     
     def __get_image_size__(self, image_url: str) -> tuple[int, int]:
         """ Return image with and height
@@ -152,6 +276,24 @@ class PageGenerator():
             tuple[int, int]: image width and height
         """
         
+        # Use cached size (also failed downloads) if image already requested
+        if image_url in self._images_sizes_cache:
+            return self._images_sizes_cache[image_url]
+        
+        image_size = self.__download_image_size__(image_url)
+        self._images_sizes_cache[image_url] = image_size
+        return image_size
+    
+    def __download_image_size__(self, image_url: str) -> tuple[int, int]:
+        """ Download image header and return image with and height
+
+        Args:
+            image_url (str): image to download
+            
+        Returns:
+            tuple[int, int]: image width and height
+        """
+        
         images_urls = []
         images_urls.append(image_url)
         if not "https://www":
@@ -160,87 +302,211 @@ class PageGenerator():
         
         for image_url in images_urls:
             try:
-                image_res = requests.get(image_url)
-                image_res.raise_for_status()
+                # Request only the first bytes (where the size is stored),
+                # and the full image if the size is not found in them
+                image_size, is_partial = self.__read_image_size__(
+                    image_url,
+                    {"Range": "bytes=0-16383"}
+                )
+                if not image_size and is_partial:
+                    image_size, _ = self.__read_image_size__(image_url)
             except Exception:
                 continue
-            image = Image.open(BytesIO(image_res.content))
-            return image.size
+            
+            if image_size:
+                return image_size
         
         return None, None
     
+    def __read_image_size__(
+        self,
+        image_url: str,
+        headers: dict = None
+    ) -> tuple[tuple[int, int], bool]:
+        """ Download image (or the requested range) and read its size
+
+        Args:
+            image_url (str): image to download
+            headers (dict): extra request headers
+            
+        Returns:
+            tuple[tuple[int, int], bool]: image width and height (None if
+                not found), and if the server returned partial content
+        """
+        
+        image_res = self._session.get(
+            image_url,
+            headers=headers,
+            stream=True,
+            timeout=5
+        )
+        with image_res:
+            image_res.raise_for_status()
+            is_partial = image_res.status_code == 206
+            
+            # WebP size is in header, stop downloading once it is read
+            chunks = []
+            header = b""
+            for chunk in image_res.iter_content(8192):
+                chunks.append(chunk)
+                if len(header) < 30:
+                    header += chunk
+                    image_size = _get_webp_size(header)
+                    if image_size:
+                        return image_size, is_partial
+            image_data = b"".join(chunks)
+        
+        # Other formats: feed the parser once with all the data, so the
+        # image header is opened a single time
+        parser = ImageFile.Parser()
+        try:
+            parser.feed(image_data)
+        except Exception:
+            return None, is_partial
+        if not parser.image:
+            return None, is_partial
+        return parser.image.size, is_partial
+    
     def generate_pages(self):
         """ Generate pages using template with and excel data """
         
         print("Generating pages...")
         
-        template_content = open(self.template_path, "r").read()
-        
-        # generate each html file with excel data
-        for row in self.excel_data[self.columns_row:]:
-            
-            sleep(0.1)
-            
-            # Create folder
-            title_index = self.excel_header.index("description")
-            page_title = row[title_index]
-            if not page_title:
+        # Generate slugs in a single batch, skipping rows without title
+        title_index = self._col_idx["description"]
+        titles = [row[title_index] for row in self.excel_data]
+        slugs = [
+            str(title).lower().replace(" ", "-") if title else None
+            for title in titles
+        ]
+        rows = []
+        rows_slugs = []
+        for row, slug in zip(self.excel_data, slugs):
+            if slug is None:
                 continue
-            slug = page_title.lower().replace(" ", "-")
+            rows.append(row)
+            rows_slugs.append(slug)
+        
+        # Get images sizes in parallel
+        image_index = self._col_idx["image url"]
+        images_urls = []
+        for row in rows:
+            image_url = row[image_index]
+            if not image_url.endswith(".webp"):
+                image_url = f"{image_url}.webp"
+            images_urls.append(image_url)
+        
+        # Download each image once, repeated urls are read from cache
+        unique_images_urls = list(dict.fromkeys(images_urls))
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(self.__get_image_size__, unique_images_urls))
+        images_sizes = [self.__get_image_size__(url) for url in images_urls]
+        
+        # Create each html folder and collect pages to render by path
+        # (repeated slugs keep the last row, each file is written once)
+        pages = {}
+        for row, slug, image_url, image_size in zip(
+            rows, rows_slugs, images_urls, images_sizes
+        ):
             
             print(f"\tGenerating page: {slug}")
             
-            # Create html folder
-            html_folder = os.path.join(self.htmls_folder, slug)
-            os.makedirs(html_folder, exist_ok=True)
-            html_path = os.path.join(html_folder, "index.html")
+            # Create html folder (htmls folder is clean: a single mkdir is
+            # enough, unless the slug has nested folders)
+            html_folder = f"{self._htmls_prefix}{slug}"
+            if os.sep in slug or (os.altsep and os.altsep in slug):
+                os.makedirs(html_folder, exist_ok=True)
+            else:
+                try:
+                    os.mkdir(html_folder)
+                except FileExistsError:
+                    pass
+            html_path = f"{html_folder}{os.sep}index.html"
             
-            # Replace each cell in template
-            content = template_content
-            for cell in row:
-                cell_index = row.index(cell)
-                current_column_name = self.excel_header[cell_index]
-                
-                content = content.replace(f"[{current_column_name}]", cell)
-                
-            # Remplace image size
-            image_url = row[self.excel_header.index("image url")]
-            if not image_url.endswith(".webp"):
-                image_url = f"{image_url}.webp"
-            image_width, image_height = self.__get_image_size__(image_url)
+            # Validate image size
+            image_width, image_height = image_size
             if not image_width and not image_height:
                 print(f"\t\tError downloading image or calculating size: {image_url}")
                 continue
-            content = content.replace("[image width]", str(image_width))
-            content = content.replace("[image height]", str(image_height))
             
-            # Save html file with content
-            with open(html_path, "w", encoding="utf-8") as file:
-                file.write(content)
+            # Convert used values to strings once (empty cells as "")
+            row_strs = []
+            for _, column_index in self._used_cols:
+                value = row[column_index]
+                row_strs.append("" if value is None else str(value))
+            pages[html_path] = (row_strs, image_size)
+        
+        # Render and save pages
+        pages_paths = list(pages.keys())
+        pages_rows = [pages[html_path][0] for html_path in pages_paths]
+        pages_images_sizes = [pages[html_path][1] for html_path in pages_paths]
+        template = (self._template_segments, self._template_slots)
+        chunksize = 32
+        if (os.cpu_count() or 1) > 1 and len(pages_paths) > chunksize:
+            
+            # In parallel, sending the template once to each worker
+            with ProcessPoolExecutor(
+                initializer=render.init_template,
+                initargs=template
+            ) as executor:
+                list(executor.map(
+                    render.render_row,
+                    pages_rows,
+                    pages_images_sizes,
+                    pages_paths,
+                    chunksize=chunksize
+                ))
+        else:
+            
+            # Single cpu or few pages: a pool only adds overhead
+            render.init_template(*template)
+            for row_strs, image_size, html_path in zip(
+                pages_rows, pages_images_sizes, pages_paths
+            ):
+                render.render_row(row_strs, image_size, html_path)
                 
+    def __iter_files__(self, folder: str):
+        """ Yield files paths inside folder (recursive)
+
+        Args:
+            folder (str): folder to walk
+            
+        Yields:
+            str: file path
+        """
+        
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    yield entry.path
+                elif entry.is_dir(follow_symlinks=False):
+                    yield from self.__iter_files__(entry.path)
+    
     def compress_htmls(self):
         """ Compress htmls folders to zip """
         
         print("Compressing htmls...")
         
         output_path = os.path.join(self.htmls_folder, "pages.zip")
-        folders = os.listdir(self.htmls_folder)
-        folders = [os.path.join(self.htmls_folder, folder) for folder in folders]
-        
-        with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with os.scandir(self.htmls_folder) as entries:
+            folders = [entry.path for entry in entries if entry.is_dir()]
+        
+        # Fast compression level: pages are small and very similar
+        with zipfile.ZipFile(
+            output_path,
+            'w',
+            zipfile.ZIP_DEFLATED,
+            compresslevel=1
+        ) as zipf:
             
             for folder in folders:
                 
                 # Walk the directory tree
-                for root, dirs, files in os.walk(folder):
-                    for file in files:
-                        # Create the relative path for the file and write it to the zip
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(
-                            file_path,
-                            os.path.join(folder, '..')
-                        )
-                        zipf.write(file_path, relative_path)
+                folder_parent = os.path.dirname(folder)
+                for file_path in self.__iter_files__(folder):
+                    # Create the relative path for the file and write it to the zip
+                    relative_path = os.path.relpath(file_path, folder_parent)
+                    zipf.write(file_path, relative_path)
     
     
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+import os
+
+# Template loaded once per process (see init_template)
+template_segments = []
+template_slots = []
+
+
+def init_template(segments: list, slots: list):
+    """ Save template in module, to render pages without sending it
+    again for each page (used as process pool initializer)
+
+    Args:
+        segments (list): template literal text encoded as bytes
+        slots (list): position of each placeholder in row values,
+            or placeholder name if is not an excel column
+    """
+
+    global template_segments, template_slots
+    template_segments = segments
+    template_slots = slots
+
+
+def render_row(row: list, image_size: tuple[int, int], html_path: str):
+    """ Render template with row data and save html file.
+    Lives in its own module, so process pool workers can import it
+
+    Args:
+        row (list): values (as strings) of the excel columns used in template
+        image_size (tuple[int, int]): image width and height
+        html_path (str): html file to write
+    """
+
+    # Fill template placeholders with row data
+    image_width, image_height = image_size
+    extra_values = {
+        "image width": image_width,
+        "image height": image_height,
+    }
+    content_parts = [template_segments[0]]
+    for slot, literal in zip(template_slots, template_segments[1:]):
+        if isinstance(slot, int):
+            value = row[slot]
+        else:
+            value = str(extra_values.get(slot, f"[{slot}]"))
+        content_parts.append(value.encode("utf-8"))
+        content_parts.append(literal)
+
+    # Save html file with content (raw write)
+    data = memoryview(b"".join(content_parts))
+    fd = os.open(html_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)